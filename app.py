@@ -1,118 +1,70 @@
 import datetime
+import functools
 import json
-import os
-import secrets
+import re
 import threading
-import pathlib
-import collections
-import shlex
-import logging
 
 import argh
-import ebooklib
-import humanize
-from bleach import clean, sanitizer
-from bs4 import BeautifulSoup
-from ebooklib import epub
-from flask import Flask, redirect, render_template, request, session, url_for, abort
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
-from tqdm import tqdm
+from flask import (
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+    session,
+    url_for,
+    abort,
+)
 from flask_login import (
     LoginManager,
-    UserMixin,
     login_user,
     logout_user,
     login_required,
     current_user,
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-import waitress
-import tabulate
-
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///reader.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SECRET_KEY"] = os.environ.get(
-    "CATREADS_SECRET_KEY", secrets.token_urlsafe(64)
+from flask_migrate import Migrate
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.exceptions import NotFound
+
+from cluster import holding_lease
+from library import (
+    filter_books,
+    locate_position,
+    parse_query,
+    save_position,
+    split_tag_names,
+    update_book_tags,
+    update_library_state,
+)
+from models import (
+    app,
+    cache,
+    db,
+    Book,
+    BookProgress,
+    Chapter,
+    LibraryState,
+    Tag,
+    User,
+    USER_CACHE_TTL,
 )
-app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 99999999999
-db = SQLAlchemy(app)
+from paragraphs import find_paragraphs
+
 migrate = Migrate(app, db)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 load_books_event = threading.Event()
 
-book_tags = db.Table(
-    "book_tags",
-    db.Column("book_id", db.Integer, db.ForeignKey("book.id"), primary_key=True),
-    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id"), primary_key=True),
-)
 
+@app.shell_context_processor
+def shell_context():
+    return {"db": db, "User": User, "Book": Book, "Tag": Tag}
 
-class Tag(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), unique=True, nullable=False)
-
-
-# Database Models
-class Book(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String, unique=True, nullable=False)
-    author = db.Column(db.String, unique=False, index=True, nullable=False)
-    title = db.Column(db.String, nullable=False)
-    chapters_count = db.Column(db.Integer, nullable=False)
-    is_hidden = db.Column(db.Boolean, nullable=False, default=False)
-    chapters = db.relationship("Chapter", backref="book", lazy=True)
-    progresses = db.relationship("BookProgress", backref="book")
-    tags = db.relationship(
-        "Tag",
-        secondary=book_tags,
-        backref=db.backref("books", lazy="dynamic"),
-        lazy="dynamic",
-    )
 
-
-class Chapter(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    index = db.Column(db.Integer, nullable=False)
-    title = db.Column(db.String, nullable=True)
-    content = db.Column(db.Text, nullable=False)
-    book_id = db.Column(
-        db.Integer, db.ForeignKey("book.id"), index=True, nullable=False
-    )
-
-
-class BookProgress(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    chapter_index = db.Column(db.Integer, nullable=False)
-    paragraph_index = db.Column(db.Integer, nullable=False, default=0)
-    updated_datetime = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    book_id = db.Column(
-        db.Integer, db.ForeignKey("book.id"), index=True, nullable=False
-    )
-    user_id = db.Column(
-        db.Integer, db.ForeignKey("user.id"), index=True, nullable=False
-    )
-
-
-class User(db.Model, UserMixin):
-    """User model and flask-login mixin."""
-
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(64), nullable=False)
-    password_hash = db.Column(db.String(200), nullable=False)
-
-    book_progresses = db.relationship(
-        "BookProgress",
-        backref=db.backref("BookProgress", lazy=True),
-    )
-
-    def set_password(self, new_password):
-        self.password_hash = generate_password_hash(new_password)
-
-    def check_password(self, maybe_password):
-        return check_password_hash(self.password_hash, maybe_password)
+def get_book_or_404(book_id):
+    """Return a book, unless it doesn't exist or is still being imported."""
+    return Book.query.filter(
+        Book.id == book_id, Book.chapters_count.isnot(None)
+    ).first_or_404()
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -145,108 +97,26 @@ def logout():
 def load_user(user_id):
     """
     This is called by flask-login on every request to load the user
+
+    Users are cached for USER_CACHE_TTL seconds so that most requests
+    don't need to query the user table. Only the id and username are
+    cached, the password hash is loaded from the database when needed.
     """
-    return User.query.filter_by(id=int(user_id)).first()
-
-
-BOOKS_DIR = "./epub"
-
-
-def save_cover_image(book_id):
-    static_dir = pathlib.Path("./static")
-    static_dir.mkdir(exist_ok=True)
-    cover_path = static_dir / f"cover-{book_id}.jpg"
-    if cover_path.is_file():
-        return
-    # Try to find the cover ID from metadata
-    book = Book.query.get_or_404(book_id)
-    book_path = os.path.join(BOOKS_DIR, book.filename)
-    book_epub = epub.read_epub(book_path, {"ignore_ncx": True})
-    cover_id = None
-    for meta in book_epub.get_metadata("OPF", "meta"):
-        if meta and len(meta) > 1 and meta[0] and meta[0].get("name") == "cover":
-            cover_id = meta[0].get("content")
-            break
-    # If cover ID is found, get the cover item
-    cover_item = None
-    if cover_id:
-        cover_item = book_epub.get_item_with_id(cover_id)
-    else:
-        # Fallback: look for an image item with 'cover' in its ID or name
-        for item in book_epub.get_items():
-            if item.get_type() == ebooklib.ITEM_IMAGE:
-                if (
-                    "cover" in item.get_id().lower()
-                    or "cover" in item.get_name().lower()
-                ):
-                    cover_item = item
-                    break
-    if cover_item:
-        with open(cover_path, "wb") as f:
-            f.write(cover_item.get_content())
-    else:
-        cover_path.symlink_to("no-cover.png")
-        print(f"No cover image found for {book_path}.")
-
-
-def load_books():
-    existing_filenames = {book.filename for book in Book.query.all()}
-    for filename in tqdm(os.listdir(BOOKS_DIR)):
-        try:
-            if filename.endswith(".epub") and filename not in existing_filenames:
-                print(f"processing {filename}")
-                book_path = os.path.join(BOOKS_DIR, filename)
-                book_epub = epub.read_epub(book_path, {"ignore_ncx": True})
-                # print(book_epub.metadata)
-                title = (
-                    book_epub.get_metadata("DC", "title")[0][0].strip()
-                    if book_epub.get_metadata("DC", "title")
-                    else "Untitled"
-                )
-                author = (
-                    book_epub.get_metadata("DC", "creator")[0][0].strip()
-                    if book_epub.get_metadata("DC", "creator")
-                    else "Unknown Author"
-                )
-
-                # Extract chapters
-                chapters = [
-                    item
-                    for item in book_epub.get_items()
-                    if item.get_type() == ebooklib.ITEM_DOCUMENT
-                ]
-                processed_chapters = []
-                allowed_tags = list(sanitizer.ALLOWED_TAGS) + ["p", "img"]
-                for index, chapter in enumerate(chapters):
-                    try:
-                        content = chapter.get_content().decode()
-                    except Exception:
-                        content = chapter.get_content()
-                    clean_content = clean(
-                        content,
-                        tags=allowed_tags,
-                        strip=True,
-                    )
-                    new_chapter = Chapter(
-                        index=index,
-                        title=f"Chapter {index + 1}",
-                        content=clean_content,
-                    )
-                    processed_chapters.append(new_chapter)
-                # Create a new Book entry
-                new_book = Book(
-                    filename=filename,
-                    title=title,
-                    author=author,
-                    chapters=processed_chapters,
-                    chapters_count=len(processed_chapters),
-                )
-                db.session.add(new_book)
-                db.session.commit()
-        except Exception as e:
-            print(filename)
-            print(str(e))
-    process_covers()
+    user_id = int(user_id)
+    values = cache.get(f"user:{user_id}")
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user:
+            cache.set(
+                f"user:{user_id}",
+                {"id": user.id, "username": user.username},
+                USER_CACHE_TTL,
+            )
+        return user
+    # attach a copy of the cached user to this session without a query
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
 
 @app.route("/apply_settings")
@@ -258,6 +128,34 @@ def apply_settings():
     return redirect(url_for("index"))
 
 
+@functools.lru_cache(maxsize=256)
+def render_theme_css(zoom, color):
+    return render_template(
+        "theme.jinja2",
+        zoom=zoom,
+        color=color,
+        contrast_color=get_contrast_color(color),
+    )
+
+
+@app.route("/theme.css")
+def theme_css():
+    """
+    Per-session zoom and color stylesheet.
+
+    The url contains all the settings, so the response never changes and
+    can be cached by the browser.
+    """
+    zoom = min(5.0, max(0.1, request.args.get("zoom", 1, type=float)))
+    color = request.args.get("color", "#000000")
+    if not re.fullmatch("#[0-9a-fA-F]{6}", color):
+        abort(400)
+    response = app.response_class(render_theme_css(zoom, color), mimetype="text/css")
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    return response
+
+
 def get_contrast_color(bg_color):
     # Remove '#' and convert hex to RGB
     hex_color = bg_color.lstrip("#")
@@ -279,32 +177,25 @@ def update_progress():
     book_id = data.get("book_id")
     chapter_index = data.get("chapter_index")
     paragraph_index = data.get("paragraph_index")
-    if book_id is None or chapter_index is None or paragraph_index is None:
+    # bool is a subclass of int, but isn't a valid index
+    if not all(
+        type(value) is int and value >= 0
+        for value in (book_id, chapter_index, paragraph_index)
+    ):
         return json.dumps({"error": "Invalid data"}), 400
 
-    progress = BookProgress.query.filter_by(
-        book_id=book_id, user_id=current_user.id
-    ).first()
-    if not progress:
-        progress = BookProgress(
-            book_id=book_id,
-            user_id=current_user.id,
-            chapter_index=chapter_index,
-            paragraph_index=paragraph_index,
-        )
-        db.session.add(progress)
-    else:
-        progress.chapter_index = chapter_index
-        progress.paragraph_index = paragraph_index
-        progress.updated_datetime = datetime.datetime.utcnow()
+    if not save_position(current_user.id, book_id, chapter_index, paragraph_index):
+        abort(404)
     db.session.commit()
     return json.dumps({"status": "success"})
 
 
 @app.template_filter("add_paragraph_ids")
 def add_paragraph_ids(content):
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(content, "html.parser")
-    for idx, p in enumerate(soup.find_all("p")):
+    for idx, p in enumerate(find_paragraphs(soup)):
         p["id"] = f"paragraph-{idx}"
     return soup.prettify()
 
@@ -312,142 +203,96 @@ def add_paragraph_ids(content):
 @app.context_processor
 def inject_globals():
     return {
-        "get_contrast_color": get_contrast_color,
         "add_paragraph_ids": add_paragraph_ids,
     }
 
 
 @app.route("/hide/<int:book_id>")
 def hide(book_id):
-    book = Book.query.get_or_404(book_id)
+    book = get_book_or_404(book_id)
     book.is_hidden = True
     for p in BookProgress.query.filter_by(book_id=book_id):
         db.session.delete(p)
+    LibraryState.query.filter_by(book_id=book_id).delete()
     db.session.commit()
     return redirect(url_for("index"))
 
 
-def add_tags(book_id, tag_names):
-    with app.app_context():
-        book = Book.query.filter_by(id=book_id).first()
-        tag_names = [tn.strip() for tn in tag_names.split(",")]
-        # go through user-supplied tags and add tags to books, creating
-        # new tags if they don't already exist
-        book.tags = []
-        for tag_name in tag_names:
-            existing_tag = Tag.query.filter_by(name=tag_name).first()
-            if existing_tag and existing_tag not in list(book.tags):
-                book.tags.append(existing_tag)
-            elif not existing_tag:
-                book.tags.append(Tag(name=tag_name))
-        db.session.commit()
-
-
 @app.route("/add_tags", methods=["POST"])
 @login_required
 def add_tags_route():
     book_id = request.form.get("book_id")
-    Book.query.get_or_404(book_id)
+    get_book_or_404(book_id)
     tag_names = request.form.get("tag_names", "")
-    add_tags(book_id, tag_names)
+    update_book_tags([int(book_id)], split_tag_names(tag_names), replace=True)
+    db.session.commit()
     return redirect(url_for("continue_reading", book_id=book_id))
 
 
-def parse_query(text, default_key="title"):
-    # parse a search query, like title:"my title" tag:mytag into
-    # { 'title': ['my title'], 'tag': ['mytag'] }
-    out = collections.defaultdict(list)
-    try:
-        tokens = shlex.split(text)
-    except ValueError as e:
-        logging.exception("Error parsing query: ")
-        return out
-
-    for token in tokens:
-        if ":" in token:
-            key, value = token.split(":", 1)
-            if v := value.strip():
-                out[key.lower()].append(v)
-        else:
-            if v := token.strip():
-                out[default_key].append(v)
-    return out
-
-
 @app.route("/")
 @login_required
 def index():
+    import humanize
+
     books = Book.query
     q = request.args.get("q", "")
     filters = parse_query(q)
 
-    if request.args.get("show_all") != "y":
-        books = books.filter_by(is_hidden=False)
-
-    for filter_sort_date in filters.get("sort", []):
-        if filter_sort_date == "author":
-            books = books.order_by(Book.author, Book.title)
-        elif filter_sort_date == "!author":
-            books = books.order_by(Book.author.desc(), Book.title)
-        # we don't have date :(
-        elif filter_sort_date == "date":
-            books = books.order_by(Book.id)
-        elif filter_sort_date == "!date":
-            books = books.order_by(Book.id.desc())
-
-    # default sort by author name
-    if not filters.get("sort"):
-        books = books.order_by(Book.author, Book.title)
-
-    # process search query for tags, author and title
-    for filter_tag_name in filters.get("tag", []):
-        if filter_tag_name.startswith("!"):
-            negated_tag = filter_tag_name[1:]
-            books = books.filter(~Book.tags.any(Tag.name == negated_tag))
-        else:
-            books = books.filter(Book.tags.any(Tag.name == filter_tag_name))
-
-    for filter_author_name in filters.get("author", []):
-        if filter_author_name.startswith("!"):
-            negated_author = filter_author_name[1:]
-            books = books.filter(~Book.author.ilike(f"%{negated_author}%"))
-        else:
-            books = books.filter(Book.author.ilike(f"%{filter_author_name}%"))
-
-    for filter_title_name in filters.get("title", []):
-        if filter_title_name.startswith("!"):
-            negated_title = filter_title_name[1:]
-            books = books.filter(~Book.title.ilike(f"%{negated_title}%"))
-        else:
-            books = books.filter(Book.title.ilike(f"%{filter_title_name}%"))
-
-    books = books.all()
+    books = filter_books(books, filters, request.args.get("show_all") == "y")
 
-    user_progresses = BookProgress.query.filter_by(user_id=current_user.id)
-    user_progresses = {up.book_id: up for up in user_progresses}
-    unread_books = []
-    finished_books = []
-    in_progress_books = []
+    # sort book list into in progress, unread and finished books using
+    # the user's library state
+    user_state = db.and_(
+        LibraryState.book_id == Book.id, LibraryState.user_id == current_user.id
+    )
+    unread_books = (
+        books.outerjoin(LibraryState, user_state)
+        .filter(LibraryState.user_id.is_(None))
+        .all()
+    )
+    finished_books = (
+        books.join(LibraryState, user_state)
+        .filter(LibraryState.status == "finished")
+        .all()
+    )
+    other_progress = db.aliased(BookProgress)
+    latest_progress = (
+        db.select(db.func.max(other_progress.id))
+        .where(
+            other_progress.book_id == Book.id,
+            other_progress.user_id == current_user.id,
+        )
+        .scalar_subquery()
+    )
+    # sort by last read
+    in_progress = (
+        books.join(LibraryState, user_state)
+        .filter(LibraryState.status == "reading")
+        .join(
+            BookProgress,
+            db.and_(
+                BookProgress.book_id == Book.id,
+                BookProgress.user_id == current_user.id,
+                # only the latest if there are several progress rows
+                BookProgress.id == latest_progress,
+            ),
+        )
+        .order_by(None)
+        .order_by(LibraryState.last_read.desc())
+        .with_entities(LibraryState, Book, BookProgress)
+        .all()
+    )
     now = datetime.datetime.utcnow()
+    in_progress_books = [
+        (now - state.last_read, book, book_progress, state)
+        for state, book, book_progress in in_progress
+    ]
 
-    # sort book list into in progress, unread and finished books
-    for book in books:
-        if not book.id in user_progresses:
-            unread_books.append(book)
-        else:
-            book_progress = user_progresses[book.id]
-            if book_progress.chapter_index + 1 >= book.chapters_count:
-                finished_books.append(book)
-            else:
-                in_progress_books.append(
-                    (now - book_progress.updated_datetime, book, book_progress)
-                )
-
-    # sort by last read
-    in_progress_books = sorted(in_progress_books, key=lambda bb: bb[0])
+    tags = Tag.query.filter(Tag.books_count > 0).order_by(Tag.name).all()
 
     return render_template(
         "index.jinja2",
+        tags=tags,
         unread_books=unread_books,
         finished_books=finished_books,
         in_progress_books=in_progress_books,
@@ -459,10 +304,12 @@ def index():
 @app.route("/book/<int:book_id>/chapter/<int:chapter_index>")
 @login_required
 def read_chapter(book_id, chapter_index):
-    book = Book.query.get_or_404(book_id)
-    chapter = Chapter.query.filter_by(
-        book_id=book_id, index=chapter_index
-    ).first_or_404()
+    book = get_book_or_404(book_id)
+    chapter = (
+        Chapter.query.options(db.joinedload(Chapter.blob))
+        .filter_by(book_id=book_id, index=chapter_index)
+        .first_or_404()
+    )
 
     # Save progress
     progress = BookProgress.query.filter_by(
@@ -480,6 +327,7 @@ def read_chapter(book_id, chapter_index):
             progress.paragraph_index = 0
         progress.chapter_index = chapter_index
         progress.updated_datetime = datetime.datetime.utcnow()
+    update_library_state(progress, book)
     db.session.commit()
 
     total_chapters = Chapter.query.filter_by(book_id=book_id).count()
@@ -502,6 +350,9 @@ def remove_progress(book_progress_id):
     if book_progress.user_id != current_user.id:
         abort(403)
     db.session.delete(book_progress)
+    LibraryState.query.filter_by(
+        user_id=current_user.id, book_id=book_progress.book_id
+    ).delete()
     db.session.commit()
     return redirect(url_for("index"))
 
@@ -518,6 +369,36 @@ def continue_reading(book_id):
     )
 
 
+@app.route("/book/<int:book_id>/goto")
+@login_required
+def goto_position(book_id):
+    book = get_book_or_404(book_id)
+    percent = min(100.0, max(0.0, request.args.get("percent", 0, type=float)))
+    chapter_index, paragraph_index = locate_position(book, percent)
+    progress = BookProgress.query.filter_by(
+        book_id=book_id, user_id=current_user.id
+    ).first()
+    if not progress:
+        progress = BookProgress(book_id=book_id, user_id=current_user.id)
+        db.session.add(progress)
+    progress.chapter_index = chapter_index
+    progress.paragraph_index = paragraph_index
+    progress.updated_datetime = datetime.datetime.utcnow()
+    update_library_state(progress, book)
+    db.session.commit()
+    return redirect(
+        url_for("read_chapter", book_id=book_id, chapter_index=chapter_index)
+    )
+
+
+@app.route("/cover/<int:book_id>.jpg")
+def cover(book_id):
+    try:
+        return send_from_directory(app.config["COVERS_DIR"], f"cover-{book_id}.jpg")
+    except NotFound:
+        return app.send_static_file("no-cover.png")
+
+
 @app.route("/trigger_load_books")
 @login_required
 def trigger_load_books():
@@ -527,59 +408,29 @@ def trigger_load_books():
 
 def run_app(debug=False):
     def load_books_thread():
+        import ingest
+
         while True:
-            with app.app_context():
-                load_books()
+            # keep the thread alive if the database is briefly unavailable
+            try:
+                with app.app_context():
+                    # only one node imports books at a time
+                    with holding_lease("load_books") as lease_lost:
+                        if lease_lost is not None:
+                            ingest.load_books(should_stop=lease_lost.is_set)
+            except Exception as e:
+                print(f"Could not load books: {e}")
             load_books_event.wait(timeout=60 * 60)
             load_books_event.clear()
 
     if debug:
         app.run(port=5438, debug=True)
     else:
+        import waitress
+
         threading.Thread(target=load_books_thread, daemon=True).start()
         waitress.serve(app, port=5438)
 
 
-def process_cover(book_id):
-    with app.app_context():
-        save_cover_image(book_id)
-
-
-def process_covers():
-    with app.app_context():
-        for book in Book.query.all():
-            process_cover(book.id)
-
-
-def attr_join(xs, attr=None, sep=","):
-    return sep.join([getattr(x, attr) for x in xs])
-
-
-def show_books():
-    ret = []
-    with app.app_context():
-        for book in Book.query.order_by(Book.title).all():
-            book_tags_str = attr_join(book.tags, "name")
-            if not book_tags_str:
-                ret.append(
-                    [
-                        book.id,
-                        book.is_hidden,
-                        book.author[:20],
-                        book.title[:40],
-                        book_tags_str,
-                    ]
-                )
-    print(tabulate.tabulate(ret))
-
-
 if __name__ == "__main__":
-    argh.dispatch_commands(
-        [
-            run_app,
-            process_cover,
-            process_covers,
-            show_books,
-            add_tags,
-        ]
-    )
+    argh.dispatch_command(run_app)
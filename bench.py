@@ -0,0 +1,147 @@
+"""
+Benchmarks for the slow parts of dreads.
+
+    env/bin/python bench.py parse [--books-dir ./epub]
+    env/bin/python bench.py update-progress [--requests 1000]
+    env/bin/python bench.py startup
+"""
+
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import argh
+import tabulate
+
+from epubreader import EpubReader
+
+
+def _parse_ebooklib(book_path):
+    # what load_books and save_cover_image used to do: the epub is read
+    # once for metadata and chapters and a second time for the cover
+    import ebooklib
+    from ebooklib import epub
+
+    book_epub = epub.read_epub(book_path, {"ignore_ncx": True})
+    book_epub.get_metadata("DC", "title")
+    book_epub.get_metadata("DC", "creator")
+    for item in book_epub.get_items():
+        if item.get_type() == ebooklib.ITEM_DOCUMENT:
+            item.get_content()
+    book_epub = epub.read_epub(book_path, {"ignore_ncx": True})
+    for item in book_epub.get_items():
+        if item.get_type() == ebooklib.ITEM_IMAGE:
+            if "cover" in item.get_id().lower() or "cover" in item.get_name().lower():
+                item.get_content()
+                break
+
+
+def _parse_epubreader(book_path):
+    with EpubReader(book_path) as book_epub:
+        for chapter in book_epub.chapters():
+            pass
+        book_epub.cover()
+
+
+def _measure(parse, book_paths):
+    tracemalloc.start()
+    start = time.perf_counter()
+    errors = 0
+    for book_path in book_paths:
+        try:
+            parse(book_path)
+        except Exception:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, errors
+
+
+def parse(books_dir="./epub"):
+    """Compare ebooklib with the single pass epub reader."""
+    book_paths = [
+        os.path.join(books_dir, filename)
+        for filename in sorted(os.listdir(books_dir))
+        if filename.endswith(".epub")
+    ]
+    rows = []
+    for name, parser in [
+        ("ebooklib", _parse_ebooklib),
+        ("epubreader", _parse_epubreader),
+    ]:
+        elapsed, peak, errors = _measure(parser, book_paths)
+        rows.append(
+            [name, len(book_paths), errors, f"{elapsed:.2f}", f"{peak / 2**20:.1f}"]
+        )
+    print(
+        tabulate.tabulate(
+            rows, headers=["parser", "books", "errors", "seconds", "peak MiB"]
+        )
+    )
+
+
+def update_progress(requests=1000):
+    """Time the progress beacon endpoint for the first user and book."""
+    from app import app
+    from models import Book, User
+
+    with app.app_context():
+        user = User.query.first()
+        book = Book.query.first()
+        payload = {"book_id": book.id, "chapter_index": 0, "paragraph_index": 0}
+        user_id = user.id
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+    start = time.perf_counter()
+    for i in range(requests):
+        payload["paragraph_index"] = i
+        client.post("/update_progress", json=payload)
+    elapsed = time.perf_counter() - start
+    print(f"{requests} requests, {elapsed / requests * 1000:.3f} ms per request")
+
+
+def _import_times(module):
+    """Return {module: cumulative import microseconds} from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def startup(top=8):
+    """Report the import time of the command line tools and the web app."""
+    rows = []
+    for module in ["cli", "app", "ingest"]:
+        times = _import_times(module)
+        heaviest = sorted(
+            (name for name in times if name != module and "." not in name),
+            key=times.get,
+            reverse=True,
+        )[:top]
+        rows.append(
+            [
+                module,
+                f"{times[module] / 1000:.0f}",
+                ", ".join(f"{name} {times[name] / 1000:.0f}" for name in heaviest),
+            ]
+        )
+    print(tabulate.tabulate(rows, headers=["module", "ms", "heaviest imports (ms)"]))
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([parse, update_progress, startup])
@@ -0,0 +1,68 @@
+"""
+Cache backends.
+
+The backend is chosen with CATREADS_CACHE_URL:
+
+    redis://host:6379/0     shared by all nodes, needs the redis package
+    local:// or unset       in this process only, for a single node and tests
+
+Values must be json serializable.
+"""
+
+import json
+import threading
+import time
+
+
+class LocalCache:
+    """In-process cache with per-key expiry."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class RedisCache:
+    """Cache shared between nodes through redis."""
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.redis.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self.redis.set(key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, key):
+        self.redis.delete(key)
+
+
+def make_cache(url=None):
+    if not url or url.startswith("local://"):
+        return LocalCache()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    raise ValueError(f"Unsupported cache url: {url}")
@@ -0,0 +1,195 @@
+"""
+Command line tools for managing the library.
+
+    env/bin/python cli.py --help
+"""
+
+import argh
+import tabulate
+
+from library import (
+    filter_books,
+    parse_query,
+    refresh_tag_counts,
+    split_tag_names,
+    update_book_tags,
+    update_library_state,
+)
+from models import app, db, Book, BookProgress, Chapter, LibraryState, Tag, book_tags
+
+
+# the ingestion module imports the epub parser and html sanitizer, so
+# it's only imported by the commands that need it
+def load_books():
+    """Import new epubs from the books directory."""
+    import ingest
+    from cluster import holding_lease
+
+    with app.app_context():
+        # a web node may be importing books too
+        with holding_lease("load_books") as lease_lost:
+            if lease_lost is None:
+                print("Another node is importing books")
+                return
+            ingest.load_books(should_stop=lease_lost.is_set)
+
+
+def process_cover(book_id):
+    import ingest
+
+    ingest.process_cover(book_id)
+
+
+def process_covers():
+    import ingest
+
+    ingest.process_covers()
+
+
+def rebuild_library_state():
+    """Recreate every user's library state from their book progress."""
+    with app.app_context():
+        LibraryState.query.delete()
+        # like the library_state migration, the latest of several progress
+        # rows for a book wins
+        progresses = (
+            db.session.query(BookProgress, Book).join(Book).order_by(BookProgress.id)
+        )
+        for progress, book in progresses:
+            update_library_state(progress, book)
+            # flush so duplicate progress rows update the same state
+            db.session.flush()
+        db.session.commit()
+        print(f"{LibraryState.query.count()} library states")
+
+
+def rebuild_paragraph_index():
+    """Build paragraph offset tables for books imported without them."""
+    from tqdm import tqdm
+
+    from ingest import blob_char_count
+
+    with app.app_context():
+        books = Book.query.filter(
+            Book.char_count.is_(None), Book.chapters_count.isnot(None)
+        )
+        for book in tqdm(books.all()):
+            book_chars = 0
+            chapters = Chapter.query.filter_by(book_id=book.id).order_by(Chapter.index)
+            for chapter in chapters:
+                chapter.char_offset = book_chars
+                book_chars += blob_char_count(chapter.content_hash) or 0
+            book.char_count = book_chars
+            db.session.commit()
+    rebuild_library_state()
+
+
+def add_tags(book_id, tag_names):
+    """Set a book's tags to the comma separated tag_names."""
+    with app.app_context():
+        _, unknown_ids = update_book_tags(
+            [int(book_id)], split_tag_names(tag_names), replace=True
+        )
+        if unknown_ids:
+            raise argh.CommandError(f"No book with id {book_id}")
+        db.session.commit()
+
+
+def bulk_tags(query, add="", remove="", show_all=False):
+    """
+    Add and remove comma separated tags on all books matching a search
+    query, e.g. bulk-tags 'author:tolkien' --add fantasy,classic
+    """
+    with app.app_context():
+        books = filter_books(Book.query, parse_query(query), show_all)
+        book_ids = [book_id for book_id, in books.with_entities(Book.id)]
+        inserted, _ = update_book_tags(
+            book_ids, split_tag_names(add), split_tag_names(remove)
+        )
+        db.session.commit()
+        print(f"{len(book_ids)} books matched, {inserted} tags added")
+
+
+def refresh_tags():
+    """Recount the number of books for every tag."""
+    with app.app_context():
+        refresh_tag_counts()
+        db.session.commit()
+
+
+def show_books():
+    """List books that don't have any tags."""
+    ret = []
+    with app.app_context():
+        # one query for books and their tags, instead of a query per book
+        books = (
+            db.session.query(
+                Book.id,
+                Book.is_hidden,
+                Book.author,
+                Book.title,
+                db.func.aggregate_strings(Tag.name, ","),
+            )
+            .outerjoin(book_tags, book_tags.c.book_id == Book.id)
+            .outerjoin(Tag, Tag.id == book_tags.c.tag_id)
+            .group_by(Book.id)
+            .order_by(Book.title)
+        )
+        for book_id, is_hidden, author, title, book_tags_str in books:
+            if not book_tags_str:
+                ret.append(
+                    [
+                        book_id,
+                        is_hidden,
+                        author[:20],
+                        title[:40],
+                        book_tags_str or "",
+                    ]
+                )
+    print(tabulate.tabulate(ret))
+
+
+def show_duplicates():
+    """List books that have the same content as another book."""
+    ret = []
+    with app.app_context():
+        duplicate_hashes = (
+            db.session.query(Book.content_hash)
+            .filter(Book.content_hash.isnot(None))
+            .group_by(Book.content_hash)
+            .having(db.func.count(Book.id) > 1)
+        )
+        books = (
+            Book.query.filter(Book.content_hash.in_(duplicate_hashes))
+            .order_by(Book.content_hash, Book.id)
+            .all()
+        )
+        for book in books:
+            ret.append(
+                [
+                    book.content_hash[:12],
+                    book.id,
+                    book.is_hidden,
+                    book.author[:20],
+                    book.title[:40],
+                    book.filename[:40],
+                ]
+            )
+    print(tabulate.tabulate(ret))
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands(
+        [
+            load_books,
+            process_cover,
+            process_covers,
+            rebuild_library_state,
+            rebuild_paragraph_index,
+            show_books,
+            show_duplicates,
+            add_tags,
+            bulk_tags,
+            refresh_tags,
+        ]
+    )
@@ -0,0 +1,107 @@
+"""
+Running several dreads nodes against one library.
+
+Work that must only run on one node at a time, like importing books, is
+guarded by a lease: a row in the lease table with the node holding it
+and when it expires. The holder renews the lease while it works, so if
+a node dies its lease runs out and another node takes over.
+"""
+
+import contextlib
+import datetime
+import os
+import socket
+import threading
+import time
+
+from models import app, db, upsert, Lease
+
+NODE_ID = os.environ.get("CATREADS_NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = 5 * 60
+
+
+def database_now(seconds=0):
+    """
+    The database's current UTC time plus seconds, as a SQL expression.
+
+    Leases are only compared with the database clock, so nodes whose
+    clocks disagree still agree on when a lease expires.
+    """
+    if db.session.get_bind().dialect.name == "sqlite":
+        return db.func.datetime("now", f"{seconds:+d} seconds", type_=db.DateTime)
+    now = db.func.timezone("UTC", db.func.now(), type_=db.DateTime)
+    return now + datetime.timedelta(seconds=seconds)
+
+
+def acquire_lease(name, ttl=LEASE_TTL):
+    """Take or renew the named lease, return whether this node holds it."""
+    db.session.execute(
+        upsert(Lease)
+        .values(name=name, owner=NODE_ID, expires=database_now())
+        .on_conflict_do_nothing()
+    )
+    # a single conditional update, so only one node can win
+    result = db.session.execute(
+        db.update(Lease)
+        .where(
+            Lease.name == name,
+            db.or_(Lease.owner == NODE_ID, Lease.expires <= database_now()),
+        )
+        .values(owner=NODE_ID, expires=database_now(ttl))
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def release_lease(name):
+    db.session.execute(
+        db.update(Lease)
+        .where(Lease.name == name, Lease.owner == NODE_ID)
+        .values(expires=database_now())
+    )
+    db.session.commit()
+
+
+@contextlib.contextmanager
+def holding_lease(name, ttl=LEASE_TTL):
+    """
+    Take the named lease for the duration of the block.
+
+    Yields None if another node holds the lease. Otherwise the lease is
+    renewed in the background until the block exits, and then released,
+    and the yielded Event is set if the lease is lost in the meantime.
+    Work done under the lease should stop once it is set.
+    """
+    if not acquire_lease(name, ttl):
+        yield None
+        return
+
+    done = threading.Event()
+    lost = threading.Event()
+
+    def renew():
+        renewed = time.monotonic()
+        with app.app_context():
+            while not done.wait(ttl / 3):
+                try:
+                    if not acquire_lease(name, ttl):
+                        print(f"{NODE_ID} lost the {name} lease")
+                        lost.set()
+                        return
+                    renewed = time.monotonic()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Could not renew the {name} lease: {e}")
+                    # another node may have taken it over by now
+                    if time.monotonic() - renewed >= ttl:
+                        lost.set()
+                        return
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield lost
+    finally:
+        done.set()
+        renewer.join()
+        release_lease(name)
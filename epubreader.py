@@ -0,0 +1,191 @@
+"""
+Single pass epub reader.
+
+The epub zip container is opened once and only the members that are
+needed are read out of it: the container and OPF package files, the
+table of contents (NCX or EPUB3 nav document), the spine documents and
+the cover image. Other images, fonts and stylesheets are never
+decompressed.
+"""
+
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+
+NS = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+    "xhtml": "http://www.w3.org/1999/xhtml",
+    "epub": "http://www.idpf.org/2007/ops",
+}
+
+DOCUMENT_MEDIA_TYPES = {"application/xhtml+xml", "text/html"}
+
+
+def _join(base_dir, href):
+    """Resolve an href relative to the directory of the file it's in."""
+    href = unquote(href.split("#", 1)[0])
+    return posixpath.normpath(posixpath.join(base_dir, href))
+
+
+def _text(element):
+    return " ".join("".join(element.itertext()).split()) if element is not None else ""
+
+
+class EpubReader:
+    """
+    Reads an epub file in one pass.
+
+    Metadata, manifest, spine, toc titles and the cover location are
+    parsed when the file is opened. Chapter contents are only read when
+    iterating over chapters(), one at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+        self.title = None
+        self.author = None
+        self.manifest = {}
+        self.spine = []
+        self.toc = {}
+        self.cover_name = None
+        # spine documents skipped by chapters() for being too big
+        self.skipped = []
+        try:
+            self._parse_package()
+        except Exception:
+            self.zip.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def _read_xml(self, name):
+        return ET.fromstring(self.zip.read(name))
+
+    def _parse_package(self):
+        container = self._read_xml("META-INF/container.xml")
+        rootfile = container.find(".//container:rootfile", NS)
+        opf_name = rootfile.get("full-path")
+        opf_dir = posixpath.dirname(opf_name)
+        package = self._read_xml(opf_name)
+
+        metadata = package.find("opf:metadata", NS)
+        if metadata is not None:
+            self.title = _text(metadata.find("dc:title", NS)) or None
+            self.author = _text(metadata.find("dc:creator", NS)) or None
+
+        # manifest id -> (zip member name, media type, properties)
+        for item in package.iterfind("opf:manifest/opf:item", NS):
+            self.manifest[item.get("id")] = (
+                _join(opf_dir, item.get("href", "")),
+                item.get("media-type", ""),
+                item.get("properties", "").split(),
+            )
+
+        spine = package.find("opf:spine", NS)
+        if spine is not None:
+            for itemref in spine.iterfind("opf:itemref", NS):
+                item = self.manifest.get(itemref.get("idref"))
+                if item and item[1] in DOCUMENT_MEDIA_TYPES:
+                    self.spine.append(item[0])
+        if not self.spine:
+            # no usable spine, fall back to manifest order
+            self.spine = [
+                name
+                for name, media_type, _ in self.manifest.values()
+                if media_type in DOCUMENT_MEDIA_TYPES
+            ]
+
+        try:
+            nav = [i for i in self.manifest.values() if "nav" in i[2]]
+            ncx_id = spine.get("toc") if spine is not None else None
+            if ncx_id in self.manifest:
+                self._parse_ncx(self.manifest[ncx_id][0])
+            elif nav:
+                self._parse_nav(nav[0][0])
+        except Exception as e:
+            # a broken toc shouldn't prevent reading the book
+            print(f"Could not read table of contents of {self.path}: {e}")
+
+        self.cover_name = self._find_cover(metadata)
+
+    def _parse_ncx(self, name):
+        ncx = self._read_xml(name)
+        ncx_dir = posixpath.dirname(name)
+        for nav_point in ncx.iter(f"{{{NS['ncx']}}}navPoint"):
+            content = nav_point.find("ncx:content", NS)
+            label = _text(nav_point.find("ncx:navLabel/ncx:text", NS))
+            if content is not None and label:
+                self.toc.setdefault(_join(ncx_dir, content.get("src", "")), label)
+
+    def _parse_nav(self, name):
+        nav_doc = self._read_xml(name)
+        nav_dir = posixpath.dirname(name)
+        for nav in nav_doc.iter(f"{{{NS['xhtml']}}}nav"):
+            if nav.get(f"{{{NS['epub']}}}type") != "toc":
+                continue
+            for a in nav.iter(f"{{{NS['xhtml']}}}a"):
+                label = _text(a)
+                if a.get("href") and label:
+                    self.toc.setdefault(_join(nav_dir, a.get("href")), label)
+
+    def _find_cover(self, metadata):
+        # EPUB2: <meta name="cover" content="manifest-id"/>
+        if metadata is not None:
+            for meta in metadata.iterfind("opf:meta", NS):
+                if meta.get("name") == "cover":
+                    item = self.manifest.get(meta.get("content"))
+                    if item:
+                        return item[0]
+        # EPUB3: <item properties="cover-image"/>
+        for name, media_type, properties in self.manifest.values():
+            if "cover-image" in properties:
+                return name
+        # Fallback: look for an image item with 'cover' in its ID or name
+        for item_id, (name, media_type, _) in self.manifest.items():
+            if media_type.startswith("image/"):
+                if "cover" in item_id.lower() or "cover" in name.lower():
+                    return name
+        return None
+
+    def chapters(self, max_size=None):
+        """
+        Yield (index, title, content bytes) in spine order.
+
+        Documents bigger than max_size bytes uncompressed are skipped and
+        added to self.skipped.
+        """
+        index = 0
+        for name in self.spine:
+            try:
+                info = self.zip.getinfo(name)
+            except KeyError:
+                print(f"{self.path}: missing spine document {name}")
+                continue
+            if max_size is not None and info.file_size > max_size:
+                print(f"{self.path}: skipping oversized document {name}")
+                self.skipped.append(name)
+                continue
+            content = self.zip.read(info)
+            yield index, self.toc.get(name), content
+            index += 1
+
+    def cover(self):
+        """Return the cover image bytes, or None if there isn't one."""
+        if not self.cover_name:
+            return None
+        try:
+            return self.zip.read(self.cover_name)
+        except KeyError:
+            return None
@@ -0,0 +1,323 @@
+"""
+Importing epubs into the library.
+
+This pulls in the html sanitizer and parser, import it only where books
+are imported.
+"""
+
+import hashlib
+import os
+import pathlib
+import resource
+
+import humanize
+import tabulate
+from bleach import clean, sanitizer
+from tqdm import tqdm
+
+from epubreader import EpubReader
+from models import app, db, Book, Chapter, ChapterBlob
+from paragraphs import paragraph_offsets, load_offsets
+
+BOOKS_DIR = "./epub"
+
+
+def write_cover_image(book_id, cover_data):
+    covers_dir = pathlib.Path(app.config["COVERS_DIR"])
+    covers_dir.mkdir(exist_ok=True)
+    cover_path = covers_dir / f"cover-{book_id}.jpg"
+    # the no-cover symlink is dangling outside of ./static
+    if cover_path.is_file() or cover_path.is_symlink():
+        return
+    if cover_data:
+        with open(cover_path, "wb") as f:
+            f.write(cover_data)
+    else:
+        cover_path.symlink_to("no-cover.png")
+        print(f"No cover image found for book {book_id}.")
+
+
+def save_cover_image(book_id):
+    cover_path = pathlib.Path(app.config["COVERS_DIR"]) / f"cover-{book_id}.jpg"
+    if cover_path.is_file() or cover_path.is_symlink():
+        return
+    book = Book.query.get_or_404(book_id)
+    book_path = os.path.join(BOOKS_DIR, book.filename)
+    with EpubReader(book_path) as book_epub:
+        write_cover_image(book_id, book_epub.cover())
+
+
+# chapters are committed to the database in batches of at most this
+# many chapters or bytes of content, so that a huge book is never held in
+# memory all at once and the database is never locked for a whole import
+CHAPTER_BATCH_SIZE = 50
+CHAPTER_BATCH_BYTES = 16 * 2**20
+
+# a book whose import grows the process RSS by more than this is abandoned
+BOOK_MEMORY_CAP = 512 * 2**20
+# chapters bigger than this (uncompressed) are skipped. Cleaning and
+# parsing a chapter takes many times its size in memory, so this is kept
+# well below the memory cap
+MAX_CHAPTER_BYTES = 4 * 2**20
+
+
+def current_rss():
+    """Return the resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # no procfs, use the peak instead
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def blob_char_count(content_hash):
+    """Return the character count of a stored chapter blob, or None."""
+    row = (
+        db.session.query(ChapterBlob.paragraph_offsets)
+        .filter_by(hash=content_hash)
+        .first()
+    )
+    if row is None:
+        return None
+    if row.paragraph_offsets is None:
+        # stored before paragraph offsets were added
+        blob = db.session.get(ChapterBlob, content_hash)
+        blob.paragraph_offsets = paragraph_offsets(blob.content)
+        return load_offsets(blob.paragraph_offsets)[-1]
+    return load_offsets(row.paragraph_offsets)[-1]
+
+
+def delete_book(book_id, blob_hashes=()):
+    """
+    Delete a partly imported book and its chapters.
+
+    Chapter blobs in blob_hashes are deleted too, unless another book
+    uses them.
+    """
+    db.session.execute(db.delete(Chapter).where(Chapter.book_id == book_id))
+    db.session.execute(db.delete(Book).where(Book.id == book_id))
+    blob_hashes = list(blob_hashes)
+    for i in range(0, len(blob_hashes), CHAPTER_BATCH_SIZE):
+        chunk = blob_hashes[i : i + CHAPTER_BATCH_SIZE]
+        db.session.execute(
+            db.delete(ChapterBlob).where(
+                ChapterBlob.hash.in_(chunk),
+                ~ChapterBlob.hash.in_(db.select(Chapter.content_hash)),
+            )
+        )
+    db.session.commit()
+
+
+def delete_incomplete_books():
+    """Delete books left over from imports that didn't finish."""
+    for (book_id,) in db.session.execute(
+        db.select(Book.id).where(Book.chapters_count.is_(None))
+    ).all():
+        book_blobs = db.select(Chapter.content_hash).where(Chapter.book_id == book_id)
+        blob_hashes = [blob_hash for blob_hash, in db.session.execute(book_blobs)]
+        print(f"deleting incomplete book {book_id}")
+        delete_book(book_id, blob_hashes)
+
+
+def check_memory(filename, start_rss, peak_rss):
+    """Return the new peak RSS, raise MemoryError if over the cap."""
+    peak_rss = max(peak_rss, current_rss())
+    if peak_rss - start_rss > BOOK_MEMORY_CAP:
+        raise MemoryError(
+            f"{filename} exceeded the import memory cap "
+            f"({humanize.naturalsize(BOOK_MEMORY_CAP, binary=True)})"
+        )
+    return peak_rss
+
+
+class ImportStopped(Exception):
+    """Raised by load_book when should_stop asks it to stop."""
+
+
+def load_book(filename, allowed_tags, should_stop=None):
+    """
+    Import one epub, committing chapters to the database in batches.
+
+    The book has no chapters_count, which hides it, until all of its
+    chapters are stored. If the import fails the book is deleted again.
+    should_stop is called before each batch is committed, the book is
+    deleted and ImportStopped raised if it returns True.
+
+    Returns (chapters count, number of chapters skipped for being bigger
+    than MAX_CHAPTER_BYTES, peak RSS in bytes, duplicate Book or None).
+    """
+    book_path = os.path.join(BOOKS_DIR, filename)
+    start_rss = peak_rss = current_rss()
+    # metadata, chapters, toc titles and the cover all come
+    # out of a single pass over the epub container
+    with EpubReader(book_path) as book_epub:
+        new_book = Book(
+            filename=filename,
+            title=book_epub.title or "Untitled",
+            author=book_epub.author or "Unknown Author",
+            chapters_count=None,
+        )
+        db.session.add(new_book)
+        db.session.commit()
+        book_id = new_book.id
+        # blobs stored by this import, deleted again if it fails
+        new_blob_hashes = []
+        try:
+            # new blobs and chapters are only added to the session when the
+            # batch is committed, so that queries in between don't autoflush
+            # them and lock the database while the next chapters are cleaned
+            batch = []
+            batch_bytes = 0
+            chapters_count = 0
+            book_hash = hashlib.sha256()
+            book_chars = 0
+            # content hash -> character count of the blobs used by this book
+            blob_chars = {}
+            for index, chapter_title, content in book_epub.chapters(MAX_CHAPTER_BYTES):
+                content_hash = hashlib.sha256(content).hexdigest()
+                book_hash.update(content_hash.encode())
+                # chapter content is content-addressed, so a chapter that's
+                # already in the library doesn't need to be cleaned or stored
+                # again
+                if content_hash not in blob_chars:
+                    blob_chars[content_hash] = blob_char_count(content_hash)
+                if blob_chars[content_hash] is None:
+                    try:
+                        content = content.decode()
+                    except Exception:
+                        pass
+                    clean_content = clean(
+                        content,
+                        tags=allowed_tags,
+                        strip=True,
+                    )
+                    new_blob = ChapterBlob(
+                        hash=content_hash,
+                        content=clean_content,
+                        paragraph_offsets=paragraph_offsets(clean_content),
+                    )
+                    batch.append(new_blob)
+                    new_blob_hashes.append(content_hash)
+                    batch_bytes += len(clean_content)
+                    blob_chars[content_hash] = load_offsets(new_blob.paragraph_offsets)[
+                        -1
+                    ]
+                batch.append(
+                    Chapter(
+                        book_id=book_id,
+                        index=index,
+                        title=chapter_title or f"Chapter {index + 1}",
+                        content_hash=content_hash,
+                        char_offset=book_chars,
+                    )
+                )
+                chapters_count += 1
+                book_chars += blob_chars[content_hash]
+                peak_rss = check_memory(filename, start_rss, peak_rss)
+                if (
+                    len(batch) >= CHAPTER_BATCH_SIZE
+                    or batch_bytes >= CHAPTER_BATCH_BYTES
+                ):
+                    if should_stop and should_stop():
+                        raise ImportStopped(f"stopped importing {filename}")
+                    # each batch is committed on its own, so the database is
+                    # only locked while the batch is written
+                    db.session.add_all(batch)
+                    db.session.commit()
+                    db.session.expunge_all()
+                    batch = []
+                    batch_bytes = 0
+            cover_data = book_epub.cover()
+            if should_stop and should_stop():
+                raise ImportStopped(f"stopped importing {filename}")
+            db.session.add_all(batch)
+            db.session.execute(
+                db.update(Book)
+                .where(Book.id == book_id)
+                .values(
+                    chapters_count=chapters_count,
+                    # a book without chapters isn't a duplicate of anything
+                    content_hash=book_hash.hexdigest() if chapters_count else None,
+                    char_count=book_chars,
+                )
+            )
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            delete_book(book_id, new_blob_hashes)
+            raise
+    duplicate = None
+    if chapters_count:
+        duplicate = Book.query.filter(
+            Book.content_hash == book_hash.hexdigest(), Book.id != book_id
+        ).first()
+    write_cover_image(book_id, cover_data)
+    skipped_count = len(book_epub.skipped)
+    return chapters_count, skipped_count, max(peak_rss, current_rss()), duplicate
+
+
+def load_books(should_stop=None):
+    """
+    Import new epubs from the books directory.
+
+    should_stop is called between books and between chapter batches, the
+    import stops if it returns True.
+    """
+    delete_incomplete_books()
+    existing_filenames = {book.filename for book in Book.query.all()}
+    allowed_tags = list(sanitizer.ALLOWED_TAGS) + ["p", "div", "img"]
+    report = []
+    for filename in tqdm(os.listdir(BOOKS_DIR)):
+        if not filename.endswith(".epub") or filename in existing_filenames:
+            continue
+        if should_stop and should_stop():
+            print("stopping the import")
+            break
+        print(f"processing {filename}")
+        try:
+            chapters_count, skipped_count, peak_rss, duplicate = load_book(
+                filename, allowed_tags, should_stop
+            )
+            status = f"duplicate of {duplicate.id}" if duplicate else "ok"
+            if skipped_count:
+                # the text of these chapters is missing from the book
+                plural = "s" if skipped_count > 1 else ""
+                status += f", {skipped_count} chapter{plural} skipped (too big)"
+        except ImportStopped as e:
+            # load_book has deleted the partly imported book
+            print(e)
+            print("stopping the import")
+            break
+        except Exception as e:
+            db.session.rollback()
+            print(filename)
+            print(str(e))
+            chapters_count, peak_rss = 0, current_rss()
+            status = f"error: {str(e)[:60]}"
+        report.append(
+            [
+                filename[:40],
+                chapters_count,
+                humanize.naturalsize(peak_rss, binary=True),
+                status,
+            ]
+        )
+    if report:
+        print(
+            tabulate.tabulate(
+                report, headers=["filename", "chapters", "peak RSS", "status"]
+            )
+        )
+    process_covers()
+
+
+def process_cover(book_id):
+    with app.app_context():
+        save_cover_image(book_id)
+
+
+def process_covers():
+    with app.app_context():
+        for book in Book.query.all():
+            process_cover(book.id)
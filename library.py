@@ -0,0 +1,381 @@
+"""
+Library queries and updates shared by the web app and command line tools.
+"""
+
+import bisect
+import collections
+import datetime
+import functools
+import logging
+import shlex
+
+from models import (
+    db,
+    Book,
+    BookProgress,
+    Chapter,
+    ChapterBlob,
+    LibraryState,
+    Tag,
+    book_tags,
+    upsert,
+)
+from paragraphs import load_offsets
+
+
+def position_percent(
+    chapters_count,
+    char_count,
+    chapter_index,
+    paragraph_index,
+    char_offset=None,
+    paragraph_offsets=None,
+):
+    """
+    Percent of a book before a position, from 0 to 100.
+
+    Exact if the chapter's char_offset and paragraph offset table are
+    given, otherwise counted in whole chapters.
+    """
+    if char_count and char_offset is not None and paragraph_offsets:
+        offsets = load_offsets(paragraph_offsets)
+        paragraph_index = max(0, min(paragraph_index or 0, len(offsets) - 1))
+        position = char_offset + offsets[paragraph_index]
+        return min(100.0, 100.0 * position / char_count)
+    if not chapters_count:
+        return 0.0
+    return min(100.0, 100.0 * chapter_index / chapters_count)
+
+
+def progress_percent(progress, book):
+    """How much of the book has been read, from 0 to 100."""
+    row = None
+    if book.char_count:
+        # exact position from the paragraph offset tables
+        row = (
+            db.session.query(Chapter.char_offset, ChapterBlob.paragraph_offsets)
+            .join(ChapterBlob)
+            .filter(Chapter.book_id == book.id, Chapter.index == progress.chapter_index)
+            .first()
+        )
+    return position_percent(
+        book.chapters_count,
+        book.char_count,
+        progress.chapter_index,
+        progress.paragraph_index,
+        *(row or ()),
+    )
+
+
+def locate_position(book, percent):
+    """
+    Find the (chapter index, paragraph index) at percent of the book.
+
+    Uses the chapter char_offset index and a binary search of the
+    chapter's paragraph offset table, without touching chapter content.
+    """
+    if not book.char_count:
+        chapter_index = int(percent / 100 * book.chapters_count)
+        return max(0, min(chapter_index, book.chapters_count - 1)), 0
+    position = int(percent / 100 * book.char_count)
+    chapter = (
+        Chapter.query.options(
+            db.joinedload(Chapter.blob).load_only(ChapterBlob.paragraph_offsets)
+        )
+        .filter(Chapter.book_id == book.id, Chapter.char_offset <= position)
+        .order_by(Chapter.char_offset.desc(), Chapter.index.desc())
+        .first()
+    )
+    if chapter is None:
+        return 0, 0
+    offsets = load_offsets(chapter.blob.paragraph_offsets or b"")
+    paragraph_index = bisect.bisect_right(offsets, position - chapter.char_offset) - 1
+    return chapter.index, max(0, min(paragraph_index, len(offsets) - 2))
+
+
+def update_library_state(progress, book=None):
+    """Bring the user's LibraryState for a book in line with their progress."""
+    if book is None:
+        book = db.session.get(Book, progress.book_id)
+    state = db.session.get(LibraryState, (progress.user_id, progress.book_id))
+    if not state:
+        state = LibraryState(user_id=progress.user_id, book_id=progress.book_id)
+        db.session.add(state)
+    finished = progress.chapter_index + 1 >= book.chapters_count
+    state.status = "finished" if finished else "reading"
+    state.last_read = progress.updated_datetime or datetime.datetime.utcnow()
+    state.percent = 100.0 if finished else progress_percent(progress, book)
+    return state
+
+
+@functools.cache
+def _position_statements():
+    """
+    The statements save_position runs, built once with bind parameters
+    so that each beacon only binds values.
+    """
+    book = Book.__table__
+    chapter = Chapter.__table__
+    blob = ChapterBlob.__table__
+    progress = BookProgress.__table__
+    state = LibraryState.__table__
+    select_book = (
+        db.select(
+            book.c.chapters_count,
+            book.c.char_count,
+            chapter.c.char_offset,
+            blob.c.paragraph_offsets,
+        )
+        .outerjoin(
+            chapter,
+            db.and_(
+                chapter.c.book_id == book.c.id,
+                chapter.c.index == db.bindparam("chapter"),
+            ),
+        )
+        .outerjoin(blob, blob.c.hash == chapter.c.content_hash)
+        .where(book.c.id == db.bindparam("book"), book.c.chapters_count.isnot(None))
+    )
+    update_progress = (
+        db.update(progress)
+        .where(
+            progress.c.book_id == db.bindparam("book"),
+            progress.c.user_id == db.bindparam("user"),
+        )
+        .values(
+            chapter_index=db.bindparam("chapter"),
+            paragraph_index=db.bindparam("paragraph"),
+            updated_datetime=db.bindparam("now"),
+        )
+    )
+    insert = upsert(state).values(
+        user_id=db.bindparam("user"),
+        book_id=db.bindparam("book"),
+        status=db.bindparam("new_status"),
+        last_read=db.bindparam("now"),
+        percent=db.bindparam("new_percent"),
+    )
+    upsert_state = insert.on_conflict_do_update(
+        index_elements=["user_id", "book_id"],
+        set_={
+            name: insert.excluded[name] for name in ["status", "last_read", "percent"]
+        },
+    )
+    return select_book, update_progress, upsert_state
+
+
+def save_position(user_id, book_id, chapter_index, paragraph_index):
+    """
+    Save a reading position sent by the reader and update the library
+    state to match.
+
+    This runs for every progress beacon, so it reads the book and chapter
+    with one query and writes with one update and one upsert. Returns
+    False, without saving anything, if there's no such book.
+    """
+    select_book, update_progress, upsert_state = _position_statements()
+    params = {
+        "user": user_id,
+        "book": book_id,
+        "chapter": chapter_index,
+        "paragraph": paragraph_index,
+        "now": datetime.datetime.utcnow(),
+    }
+    row = db.session.execute(select_book, params).first()
+    if row is None:
+        return False
+    if db.session.execute(update_progress, params).rowcount == 0:
+        db.session.add(
+            BookProgress(
+                book_id=book_id,
+                user_id=user_id,
+                chapter_index=chapter_index,
+                paragraph_index=paragraph_index,
+                updated_datetime=params["now"],
+            )
+        )
+    finished = chapter_index + 1 >= row.chapters_count
+    params["new_status"] = "finished" if finished else "reading"
+    params["new_percent"] = (
+        100.0
+        if finished
+        else position_percent(
+            row.chapters_count,
+            row.char_count,
+            chapter_index,
+            paragraph_index,
+            row.char_offset,
+            row.paragraph_offsets,
+        )
+    )
+    db.session.execute(upsert_state, params)
+    return True
+
+
+def split_tag_names(tag_names):
+    return [tn.strip() for tn in tag_names.split(",") if tn.strip()]
+
+
+def resolve_tags(tag_names):
+    """
+    Return {tag name: tag id} for tag_names, creating missing tags.
+    """
+    if not tag_names:
+        return {}
+    tag_ids = dict(
+        db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(tag_names)).all()
+    )
+    missing = [tag_name for tag_name in set(tag_names) if tag_name not in tag_ids]
+    if missing:
+        db.session.execute(
+            upsert(Tag).on_conflict_do_nothing(),
+            [{"name": tag_name} for tag_name in missing],
+        )
+        tag_ids.update(
+            db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)).all()
+        )
+    return tag_ids
+
+
+def refresh_tag_counts(tag_ids=None):
+    """Recount Tag.books_count, for all tags or only for tag_ids."""
+    count = (
+        db.select(db.func.count())
+        .select_from(book_tags)
+        .where(book_tags.c.tag_id == Tag.id)
+        .scalar_subquery()
+    )
+    update = db.update(Tag).values(books_count=count)
+    if tag_ids is not None:
+        update = update.where(Tag.id.in_(tag_ids))
+    db.session.execute(update)
+
+
+def update_book_tags(book_ids, add_names=(), remove_names=(), replace=False):
+    """
+    Add and remove tags on many books at once.
+
+    With replace, the books' existing tags are removed first. Books that
+    don't exist are skipped. Returns the number of book_tags rows inserted
+    and the ids of the skipped books.
+    """
+    existing_ids = {
+        book_id
+        for book_id, in db.session.query(Book.id).filter(
+            Book.id.in_(book_ids), Book.chapters_count.isnot(None)
+        )
+    }
+    unknown_ids = [book_id for book_id in book_ids if book_id not in existing_ids]
+    book_ids = [book_id for book_id in book_ids if book_id in existing_ids]
+    if not book_ids:
+        # don't create tags that no book would have
+        return 0, unknown_ids
+    add_ids = list(resolve_tags(list(add_names)).values())
+    remove_ids = list(
+        dict(
+            db.session.query(Tag.name, Tag.id)
+            .filter(Tag.name.in_(list(remove_names)))
+            .all()
+        ).values()
+    )
+    touched_ids = set(add_ids) | set(remove_ids)
+    if replace:
+        touched_ids.update(
+            tag_id
+            for tag_id, in db.session.query(book_tags.c.tag_id)
+            .filter(book_tags.c.book_id.in_(book_ids))
+            .distinct()
+        )
+        db.session.execute(book_tags.delete().where(book_tags.c.book_id.in_(book_ids)))
+    elif remove_ids:
+        db.session.execute(
+            book_tags.delete().where(
+                book_tags.c.book_id.in_(book_ids), book_tags.c.tag_id.in_(remove_ids)
+            )
+        )
+    if touched_ids and book_ids:
+        db.session.execute(
+            db.update(Book)
+            .where(Book.id.in_(book_ids))
+            .values(updated_datetime=datetime.datetime.utcnow())
+        )
+    inserted = 0
+    if add_ids and book_ids:
+        result = db.session.execute(
+            upsert(book_tags).on_conflict_do_nothing(),
+            [
+                {"book_id": book_id, "tag_id": tag_id}
+                for book_id in book_ids
+                for tag_id in add_ids
+            ],
+        )
+        inserted = result.rowcount
+    refresh_tag_counts(touched_ids)
+    return inserted, unknown_ids
+
+
+def parse_query(text, default_key="title"):
+    # parse a search query, like title:"my title" tag:mytag into
+    # { 'title': ['my title'], 'tag': ['mytag'] }
+    out = collections.defaultdict(list)
+    try:
+        tokens = shlex.split(text)
+    except ValueError as e:
+        logging.exception("Error parsing query: ")
+        return out
+
+    for token in tokens:
+        if ":" in token:
+            key, value = token.split(":", 1)
+            if v := value.strip():
+                out[key.lower()].append(v)
+        else:
+            if v := token.strip():
+                out[default_key].append(v)
+    return out
+
+
+def filter_books(books, filters, show_all=False):
+    """Apply parsed search query filters and sorting to a Book query."""
+    # books that are still being imported are never listed
+    books = books.filter(Book.chapters_count.isnot(None))
+    if not show_all:
+        books = books.filter_by(is_hidden=False)
+
+    for filter_sort_date in filters.get("sort", []):
+        if filter_sort_date == "author":
+            books = books.order_by(Book.author, Book.title)
+        elif filter_sort_date == "!author":
+            books = books.order_by(Book.author.desc(), Book.title)
+        # we don't have date :(
+        elif filter_sort_date == "date":
+            books = books.order_by(Book.id)
+        elif filter_sort_date == "!date":
+            books = books.order_by(Book.id.desc())
+
+    # default sort by author name
+    if not filters.get("sort"):
+        books = books.order_by(Book.author, Book.title)
+
+    # process search query for tags, author and title
+    for filter_tag_name in filters.get("tag", []):
+        if filter_tag_name.startswith("!"):
+            negated_tag = filter_tag_name[1:]
+            books = books.filter(~Book.tags.any(Tag.name == negated_tag))
+        else:
+            books = books.filter(Book.tags.any(Tag.name == filter_tag_name))
+
+    for filter_author_name in filters.get("author", []):
+        if filter_author_name.startswith("!"):
+            negated_author = filter_author_name[1:]
+            books = books.filter(~Book.author.ilike(f"%{negated_author}%"))
+        else:
+            books = books.filter(Book.author.ilike(f"%{filter_author_name}%"))
+
+    for filter_title_name in filters.get("title", []):
+        if filter_title_name.startswith("!"):
+            negated_title = filter_title_name[1:]
+            books = books.filter(~Book.title.ilike(f"%{negated_title}%"))
+        else:
+            books = books.filter(Book.title.ilike(f"%{filter_title_name}%"))
+    return books
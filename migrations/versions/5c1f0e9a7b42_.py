@@ -0,0 +1,91 @@
+"""content-addressed chapter storage
+
+Revision ID: 5c1f0e9a7b42
+Revises: 3110d78e66c3
+Create Date: 2026-10-19 10:12:40.118305
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f0e9a7b42'
+down_revision = '3110d78e66c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chapter_blob',
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('hash')
+    )
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_book_content_hash'), ['content_hash'], unique=False)
+
+    with op.batch_alter_table('chapter', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+
+    # Move existing chapter content into blobs. The original epub documents
+    # aren't available here, so existing chapters are keyed by the hash of
+    # their cleaned content instead. They still deduplicate against each
+    # other, but not against books imported after this migration.
+    conn = op.get_bind()
+    book_ids = [row[0] for row in conn.execute(sa.text("SELECT id FROM book"))]
+    for book_id in book_ids:
+        chapters = conn.execute(
+            sa.text('SELECT id, content FROM chapter WHERE book_id = :book_id ORDER BY "index"'),
+            {"book_id": book_id},
+        ).fetchall()
+        book_hash = hashlib.sha256()
+        for chapter_id, content in chapters:
+            content_hash = hashlib.sha256(content.encode()).hexdigest()
+            book_hash.update(content_hash.encode())
+            conn.execute(
+                sa.text("INSERT INTO chapter_blob (hash, content) VALUES (:hash, :content) ON CONFLICT DO NOTHING"),
+                {"hash": content_hash, "content": content},
+            )
+            conn.execute(
+                sa.text("UPDATE chapter SET content_hash = :hash WHERE id = :id"),
+                {"hash": content_hash, "id": chapter_id},
+            )
+        if not chapters:
+            # a book without chapters isn't a duplicate of anything
+            continue
+        conn.execute(
+            sa.text("UPDATE book SET content_hash = :hash WHERE id = :id"),
+            {"hash": book_hash.hexdigest(), "id": book_id},
+        )
+
+    with op.batch_alter_table('chapter', schema=None) as batch_op:
+        batch_op.alter_column('content_hash', existing_type=sa.String(length=64), nullable=False)
+        batch_op.create_index(batch_op.f('ix_chapter_content_hash'), ['content_hash'], unique=False)
+        batch_op.create_foreign_key('fk_chapter_content_hash_chapter_blob', 'chapter_blob', ['content_hash'], ['hash'])
+        batch_op.drop_column('content')
+
+
+def downgrade():
+    with op.batch_alter_table('chapter', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content', sa.Text(), nullable=True))
+
+    op.execute(
+        "UPDATE chapter SET content = "
+        "(SELECT content FROM chapter_blob WHERE chapter_blob.hash = chapter.content_hash)"
+    )
+
+    with op.batch_alter_table('chapter', schema=None) as batch_op:
+        batch_op.alter_column('content', existing_type=sa.Text(), nullable=False)
+        batch_op.drop_constraint('fk_chapter_content_hash_chapter_blob', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_chapter_content_hash'))
+        batch_op.drop_column('content_hash')
+
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_book_content_hash'))
+        batch_op.drop_column('content_hash')
+
+    op.drop_table('chapter_blob')
@@ -0,0 +1,210 @@
+"""
+Flask app, database and models.
+
+This is shared by the web app (app.py) and the command line tools
+(cli.py, snapshot.py), so it only imports what the models need.
+
+Configuration comes from the environment:
+
+    CATREADS_SECRET_KEY     session signing key, required in cluster mode
+    CATREADS_DATABASE_URI   database, defaults to sqlite:///reader.db. SQLite
+                            and PostgreSQL are supported, cluster mode
+                            needs PostgreSQL
+    CATREADS_COVERS_DIR     where cover images are kept, defaults to ./static
+    CATREADS_CACHE_URL      cache backend, see cache.py
+    CATREADS_CLUSTER        set to 1 when running several nodes
+"""
+
+import datetime
+import os
+import secrets
+
+from flask import Flask
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from cache import make_cache
+
+app = Flask(__name__)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "CATREADS_DATABASE_URI", "sqlite:///reader.db"
+)
+if os.environ.get("CATREADS_CLUSTER") == "1":
+    # every node must sign sessions with the same key
+    if not os.environ.get("CATREADS_SECRET_KEY"):
+        raise RuntimeError("CATREADS_SECRET_KEY must be set when CATREADS_CLUSTER=1")
+    # SQLite on a shared mount isn't safely lockable, and every node
+    # would queue on its single writer lock
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+        raise RuntimeError("CATREADS_CLUSTER=1 needs a PostgreSQL database")
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SECRET_KEY"] = os.environ.get(
+    "CATREADS_SECRET_KEY", secrets.token_urlsafe(64)
+)
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 99999999999
+app.config["COVERS_DIR"] = os.path.abspath(
+    os.environ.get("CATREADS_COVERS_DIR", "./static")
+)
+db = SQLAlchemy(app)
+cache = make_cache(os.environ.get("CATREADS_CACHE_URL"))
+
+
+def upsert(table):
+    """
+    Return an insert statement for table that supports
+    on_conflict_do_nothing() and on_conflict_do_update().
+    """
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+book_tags = db.Table(
+    "book_tags",
+    db.Column("book_id", db.Integer, db.ForeignKey("book.id"), primary_key=True),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id"), primary_key=True),
+)
+
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    # number of books with this tag, see refresh_tag_counts()
+    books_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+
+# Database Models
+class Book(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String, unique=True, nullable=False)
+    author = db.Column(db.String, unique=False, index=True, nullable=False)
+    title = db.Column(db.String, nullable=False)
+    # None while the book is still being imported
+    chapters_count = db.Column(db.Integer, nullable=True)
+    is_hidden = db.Column(db.Boolean, nullable=False, default=False)
+    # sha256 over the book's chapter hashes, identical for duplicate books
+    content_hash = db.Column(db.String(64), index=True, nullable=True)
+    char_count = db.Column(db.Integer, nullable=True)
+    # last time the book or its tags changed, for incremental snapshots
+    updated_datetime = db.Column(
+        db.DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+        index=True,
+        nullable=True,
+    )
+    chapters = db.relationship("Chapter", backref="book", lazy=True)
+    progresses = db.relationship("BookProgress", backref="book")
+    tags = db.relationship(
+        "Tag",
+        secondary=book_tags,
+        backref=db.backref("books", lazy="dynamic"),
+        lazy="dynamic",
+    )
+
+
+class ChapterBlob(db.Model):
+    """Cleaned chapter content, stored once per distinct source document."""
+
+    # sha256 of the chapter document as it is in the epub
+    hash = db.Column(db.String(64), primary_key=True)
+    content = db.Column(db.Text, nullable=False)
+    # array of cumulative character counts at the start of each paragraph,
+    # see paragraph_offsets()
+    paragraph_offsets = db.Column(db.LargeBinary, nullable=True)
+
+
+class Chapter(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String, nullable=True)
+    content_hash = db.Column(
+        db.String(64), db.ForeignKey("chapter_blob.hash"), index=True, nullable=False
+    )
+    book_id = db.Column(
+        db.Integer, db.ForeignKey("book.id"), index=True, nullable=False
+    )
+    # number of characters in the book before this chapter
+    char_offset = db.Column(db.Integer, nullable=True)
+    blob = db.relationship("ChapterBlob")
+
+    __table_args__ = (
+        db.Index("ix_chapter_book_id_char_offset", "book_id", "char_offset"),
+    )
+
+    @property
+    def content(self):
+        return self.blob.content
+
+
+class BookProgress(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    chapter_index = db.Column(db.Integer, nullable=False)
+    # the first paragraph visible in the reader, progress is counted from
+    # the start of this paragraph
+    paragraph_index = db.Column(db.Integer, nullable=False, default=0)
+    updated_datetime = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    book_id = db.Column(
+        db.Integer, db.ForeignKey("book.id"), index=True, nullable=False
+    )
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), index=True, nullable=False
+    )
+
+
+class LibraryState(db.Model):
+    """
+    Per-user reading status of a book, derived from BookProgress.
+
+    Kept up to date whenever progress changes so that the index page can
+    list in progress and finished books with indexed queries.
+    """
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey("book.id"), primary_key=True)
+    # "reading" or "finished"; unread books have no row
+    status = db.Column(db.String(16), nullable=False)
+    last_read = db.Column(db.DateTime, nullable=False)
+    percent = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index(
+            "ix_library_state_user_status_last_read", "user_id", "status", "last_read"
+        ),
+        db.Index("ix_library_state_book_id", "book_id"),
+    )
+
+
+# how long users are kept in the cache, see load_user
+USER_CACHE_TTL = 60
+
+
+class User(db.Model, UserMixin):
+    """User model and flask-login mixin."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(64), nullable=False)
+    password_hash = db.Column(db.String(200), nullable=False)
+
+    book_progresses = db.relationship(
+        "BookProgress",
+        backref=db.backref("BookProgress", lazy=True),
+    )
+
+    def set_password(self, new_password):
+        self.password_hash = generate_password_hash(new_password)
+        cache.delete(f"user:{self.id}")
+
+    def check_password(self, maybe_password):
+        return check_password_hash(self.password_hash, maybe_password)
+
+
+class Lease(db.Model):
+    """A named lock held by one node until it expires, see cluster.py."""
+
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(128), nullable=False)
+    expires = db.Column(db.DateTime, nullable=False)
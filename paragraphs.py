@@ -0,0 +1,41 @@
+"""
+Paragraph offset tables.
+
+A chapter's paragraph offset table holds the number of characters before
+each paragraph, so that reading positions can be converted to and from
+percentages without parsing chapter content.
+"""
+
+import array
+
+# block elements that are counted as paragraphs, if they don't contain
+# other paragraphs
+PARAGRAPH_TAGS = ["p", "div", "li", "blockquote"]
+
+
+def find_paragraphs(soup):
+    return [
+        tag for tag in soup.find_all(PARAGRAPH_TAGS) if not tag.find(PARAGRAPH_TAGS)
+    ]
+
+
+def paragraph_offsets(content):
+    """
+    Return the paragraph offset table of chapter content as bytes.
+
+    This is an array of n + 1 unsigned ints for n paragraphs: the number
+    of characters before each paragraph, followed by the total.
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, "html.parser")
+    offsets = array.array("I", [0])
+    for paragraph in find_paragraphs(soup):
+        offsets.append(offsets[-1] + len(paragraph.get_text()))
+    return offsets.tobytes()
+
+
+def load_offsets(data):
+    offsets = array.array("I")
+    offsets.frombytes(data)
+    return offsets
@@ -0,0 +1,377 @@
+"""
+Export and restore the library database as a portable snapshot.
+
+    env/bin/python snapshot.py export library.tar
+    env/bin/python snapshot.py export library-2.tar --since library.tar
+    env/bin/python snapshot.py restore library.tar
+
+A snapshot is an uncompressed tar stream. It holds a manifest, one json
+lines member per table, one zlib-compressed member per chapter blob and
+the cover images. An incremental snapshot (--since) contains only the
+books, progress and library state that changed after the previous
+snapshot was taken. Restoring a full snapshot followed by its
+incremental snapshots, in order, brings a database up to date. Deleted
+progress is not carried over by incremental snapshots.
+
+Snapshots include the user table with password hashes, keep them private.
+"""
+
+import base64
+import concurrent.futures
+import datetime
+import io
+import json
+import os
+import pathlib
+import re
+import tarfile
+import tempfile
+import time
+import zlib
+
+import argh
+from models import (
+    app,
+    db,
+    Book,
+    BookProgress,
+    Chapter,
+    ChapterBlob,
+    LibraryState,
+    Tag,
+    User,
+    book_tags,
+    upsert,
+)
+
+SNAPSHOT_VERSION = 1
+# number of rows per bulk insert
+INSERT_BATCH_SIZE = 5000
+# number of chapter blobs decompressed in parallel per batch
+BLOB_BATCH_SIZE = 512
+# the only symlink allowed among the covers, see write_cover_image
+NO_COVER = "no-cover.png"
+
+
+def _dump_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    return value
+
+
+def _load_row(table, row):
+    for column in table.columns:
+        value = row.get(column.name)
+        if value is None:
+            continue
+        if isinstance(column.type, db.DateTime):
+            row[column.name] = datetime.datetime.fromisoformat(value)
+        elif isinstance(column.type, db.LargeBinary):
+            row[column.name] = base64.b64decode(value)
+    return row
+
+
+def _add_member(tar, name, fileobj, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    tar.addfile(info, fileobj)
+
+
+def _add_bytes(tar, name, data):
+    _add_member(tar, name, io.BytesIO(data), len(data))
+
+
+def _add_table(tar, table, where=None):
+    """Write the rows of table as a json lines member, return the count."""
+    query = db.select(table)
+    if where is not None:
+        query = query.where(where)
+    count = 0
+    with tempfile.SpooledTemporaryFile(max_size=64 * 2**20) as f:
+        rows = db.session.execute(query.execution_options(yield_per=INSERT_BATCH_SIZE))
+        for row in rows.mappings():
+            line = {k: _dump_value(v) for k, v in row.items()}
+            f.write(json.dumps(line).encode())
+            f.write(b"\n")
+            count += 1
+        size = f.tell()
+        f.seek(0)
+        _add_member(tar, f"{table.name}.jsonl", f, size)
+    return count
+
+
+def export(path, since=None):
+    """Write a snapshot of the library to path."""
+    with app.app_context():
+        created = datetime.datetime.utcnow()
+        since_datetime = None
+        if since:
+            with tarfile.open(since, "r|") as previous:
+                for member in previous:
+                    if member.name == "manifest.json":
+                        manifest = json.load(previous.extractfile(member))
+                        since_datetime = datetime.datetime.fromisoformat(
+                            manifest["created"]
+                        )
+                        break
+            if since_datetime is None:
+                raise ValueError(f"{since} has no manifest")
+
+        # books that are still being imported are left out
+        changed_books = db.select(Book.id).where(Book.chapters_count.isnot(None))
+        changed_progress = None
+        changed_states = None
+        if since_datetime:
+            changed_books = changed_books.where(Book.updated_datetime > since_datetime)
+            changed_progress = BookProgress.updated_datetime > since_datetime
+            changed_states = LibraryState.last_read > since_datetime
+        changed_blobs = db.select(Chapter.content_hash).where(
+            Chapter.book_id.in_(changed_books)
+        )
+
+        with tarfile.open(path, "w|") as tar:
+            manifest = {
+                "version": SNAPSHOT_VERSION,
+                "created": created.isoformat(),
+                "since": since_datetime.isoformat() if since_datetime else None,
+            }
+            _add_bytes(tar, "manifest.json", json.dumps(manifest).encode())
+
+            counts = {
+                "user": _add_table(tar, User.__table__),
+                "tag": _add_table(tar, Tag.__table__),
+                "book": _add_table(tar, Book.__table__, Book.id.in_(changed_books)),
+                "book_tags": _add_table(
+                    tar, book_tags, book_tags.c.book_id.in_(changed_books)
+                ),
+            }
+
+            # blobs go before the chapters that reference them
+            blobs = db.session.execute(
+                db.select(
+                    ChapterBlob.hash,
+                    ChapterBlob.content,
+                    ChapterBlob.paragraph_offsets,
+                )
+                .where(ChapterBlob.hash.in_(changed_blobs))
+                .execution_options(yield_per=BLOB_BATCH_SIZE)
+            )
+            counts["chapter_blob"] = 0
+            for blob_hash, content, offsets in blobs:
+                # offsets go first so they're at hand when the blob is restored
+                if offsets is not None:
+                    _add_bytes(tar, f"blobs/{blob_hash}.offsets", offsets)
+                _add_bytes(tar, f"blobs/{blob_hash}", zlib.compress(content.encode()))
+                counts["chapter_blob"] += 1
+
+            counts["chapter"] = _add_table(
+                tar, Chapter.__table__, Chapter.book_id.in_(changed_books)
+            )
+            counts["book_progress"] = _add_table(
+                tar, BookProgress.__table__, changed_progress
+            )
+            counts["library_state"] = _add_table(
+                tar, LibraryState.__table__, changed_states
+            )
+
+            covers_dir = pathlib.Path(app.config["COVERS_DIR"])
+            counts["covers"] = 0
+            for (book_id,) in db.session.execute(changed_books):
+                cover_path = covers_dir / f"cover-{book_id}.jpg"
+                if cover_path.is_symlink():
+                    info = tarfile.TarInfo(f"covers/{cover_path.name}")
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = os.readlink(cover_path)
+                    tar.addfile(info)
+                elif cover_path.is_file():
+                    tar.add(cover_path, f"covers/{cover_path.name}")
+                else:
+                    continue
+                counts["covers"] += 1
+
+    for name, count in counts.items():
+        print(f"{name}: {count}")
+
+
+def _upsert(table, rows):
+    """Insert rows, replacing existing rows with the same primary key."""
+    if not rows:
+        return
+    insert = upsert(table)
+    primary_key = [column.name for column in table.primary_key]
+    update = {
+        column.name: insert.excluded[column.name]
+        for column in table.columns
+        if column.name not in primary_key
+    }
+    if update:
+        insert = insert.on_conflict_do_update(index_elements=primary_key, set_=update)
+    else:
+        insert = insert.on_conflict_do_nothing()
+    db.session.execute(insert, rows)
+
+
+def _restore_table(table, fileobj):
+    """
+    Bulk insert a json lines table member.
+
+    Returns the number of rows and their ids, if the table has an id.
+    """
+    count = 0
+    ids = []
+    rows = []
+    for line in fileobj:
+        row = _load_row(table, json.loads(line))
+        if "id" in row:
+            ids.append(row["id"])
+        rows.append(row)
+        count += 1
+        if len(rows) >= INSERT_BATCH_SIZE:
+            _upsert(table, rows)
+            rows = []
+    _upsert(table, rows)
+    return count, ids
+
+
+def _restore_blobs(executor, batch, offsets):
+    hashes = list(batch)
+    contents = executor.map(zlib.decompress, batch.values())
+    rows = [
+        {
+            "hash": blob_hash,
+            "content": content.decode(),
+            "paragraph_offsets": offsets.pop(blob_hash, None),
+        }
+        for blob_hash, content in zip(hashes, contents)
+    ]
+    _upsert(ChapterBlob.__table__, rows)
+
+
+def _reset_sequences():
+    """
+    Restored rows keep their ids, so move PostgreSQL's id sequences past
+    them. SQLite picks the next id from the table itself.
+    """
+    if db.session.get_bind().dialect.name != "postgresql":
+        return
+    for model in [User, Tag, Book, Chapter, BookProgress]:
+        name = model.__tablename__
+        db.session.execute(
+            db.text(
+                f"SELECT setval(pg_get_serial_sequence('\"{name}\"', 'id'), "
+                f'COALESCE(MAX(id), 0) + 1, false) FROM "{name}"'
+            )
+        )
+
+
+def _is_empty():
+    for model in [User, Tag, Book, ChapterBlob]:
+        if db.session.query(model).first() is not None:
+            return False
+    return True
+
+
+def restore(path, workers=os.cpu_count()):
+    """
+    Restore a snapshot written by export into the database.
+
+    A full snapshot can only be restored into an empty database, its rows
+    keep their ids and would replace unrelated rows with the same ids.
+    """
+    tables = {
+        table.name: table
+        for table in [
+            User.__table__,
+            Tag.__table__,
+            Book.__table__,
+            book_tags,
+            Chapter.__table__,
+            BookProgress.__table__,
+            LibraryState.__table__,
+        ]
+    }
+    covers_dir = pathlib.Path(app.config["COVERS_DIR"])
+    covers_dir.mkdir(exist_ok=True)
+    start = time.perf_counter()
+    with app.app_context(), tarfile.open(
+        path, "r|"
+    ) as tar, concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        manifest = None
+        book_ids = []
+        # hash -> compressed content, decompressed in parallel in batches
+        blob_batch = {}
+        blob_offsets = {}
+        for member in tar:
+            if member.name == "manifest.json":
+                manifest = json.load(tar.extractfile(member))
+                if manifest["version"] != SNAPSHOT_VERSION:
+                    raise ValueError(f"unsupported snapshot version {manifest}")
+                if manifest["since"] is None and not _is_empty():
+                    raise ValueError(
+                        f"{path} is a full snapshot, it can only be restored "
+                        "into an empty database"
+                    )
+            elif manifest is None:
+                raise ValueError(f"{path} has no manifest")
+            elif member.name.endswith(".jsonl"):
+                if blob_batch:
+                    # chapters reference the blobs before them
+                    _restore_blobs(executor, blob_batch, blob_offsets)
+                    blob_batch = {}
+                table = tables[member.name[: -len(".jsonl")]]
+                if table is book_tags or table is Chapter.__table__:
+                    # the snapshot has the complete tags and chapters of
+                    # the books in it
+                    for i in range(0, len(book_ids), INSERT_BATCH_SIZE):
+                        chunk = book_ids[i : i + INSERT_BATCH_SIZE]
+                        db.session.execute(
+                            table.delete().where(table.c.book_id.in_(chunk))
+                        )
+                count, ids = _restore_table(table, tar.extractfile(member))
+                if table is Book.__table__:
+                    book_ids = ids
+                print(f"{table.name}: {count}")
+            elif member.name.endswith(".offsets"):
+                blob_hash = member.name[len("blobs/") : -len(".offsets")]
+                blob_offsets[blob_hash] = tar.extractfile(member).read()
+            elif member.name.startswith("blobs/"):
+                blob_hash = member.name[len("blobs/") :]
+                blob_batch[blob_hash] = tar.extractfile(member).read()
+                if len(blob_batch) >= BLOB_BATCH_SIZE:
+                    _restore_blobs(executor, blob_batch, blob_offsets)
+                    blob_batch = {}
+            elif member.name.startswith("covers/"):
+                if blob_batch:
+                    _restore_blobs(executor, blob_batch, blob_offsets)
+                    blob_batch = {}
+                cover_name = pathlib.PurePosixPath(member.name).name
+                if not re.fullmatch(r"cover-\d+\.jpg", cover_name) or not (
+                    member.isfile() or member.issym()
+                ):
+                    print(f"skipping {member.name}")
+                    continue
+                if member.issym() and member.linkname != NO_COVER:
+                    # the cover route follows symlinks, only the no-cover
+                    # placeholder is a safe target
+                    print(f"skipping {member.name} linking to {member.linkname}")
+                    continue
+                cover_path = covers_dir / cover_name
+                if cover_path.is_symlink() or cover_path.exists():
+                    cover_path.unlink()
+                if member.issym():
+                    cover_path.symlink_to(NO_COVER)
+                else:
+                    with open(cover_path, "wb") as f:
+                        f.write(tar.extractfile(member).read())
+        if blob_batch:
+            _restore_blobs(executor, blob_batch, blob_offsets)
+        _reset_sequences()
+        db.session.commit()
+    print(f"restored {path} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([export, restore])